@@ -9,7 +9,116 @@ on ZaP-HD.
 '''
 
 # GENERAL IMPORTS --------------------------
+import atexit
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from scipy.linalg import lstsq
+from scipy.optimize import curve_fit
+from scipy.signal import find_peaks, peak_widths
+
+try:
+    from numba import njit
+except ImportError:
+    # numba is optional, fall back to plain numpy
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+
+# MATLAB engine shared across readSPE calls, started on first use
+_MATLAB_ENGINE = None
+
+
+def _getMatlabEngine():
+    '''
+    Returns the shared MATLAB engine, starting it on first use. Starting
+    the engine takes seconds, so it is kept alive for the session and
+    shut down at interpreter exit.
+
+    REQUIRES MATLAB AND THE MATLAB ENGINE INSTALLED!!!11!!!1!
+    see: https://www.mathworks.com/help/matlab/matlab_external/install-the-matlab-engine-for-python.html
+    '''
+    global _MATLAB_ENGINE
+
+    if _MATLAB_ENGINE is None:
+        import matlab.engine
+
+        engine = matlab.engine.start_matlab()
+        atexit.register(engine.quit)
+        # loadSPE.m lives next to this file, only cache the engine once it's on the path
+        engine.addpath(os.path.dirname(os.path.abspath(__file__)), nargout=0)
+        _MATLAB_ENGINE = engine
+
+    return _MATLAB_ENGINE
+
+
+''' ----------------------------------------------------------------
+                    MODEL FUNCTIONS
+--------------------------------------------------------------------
+'''
+@njit(cache=True, fastmath=True, nogil=True)
+def _gauss_kernel(x, A, x_0, width, yoffset):
+    return A*np.exp(-(x-x_0)**2/(2*width**2)) + yoffset
+
+
+@njit(cache=True, fastmath=True, nogil=True)
+def _gauss_jac_kernel(x, A, x_0, width, yoffset):
+    # analytic partial derivatives w.r.t. (A, x_0, width, yoffset)
+    exponential = np.exp(-(x-x_0)**2/(2*width**2))
+    jacobian = np.empty((x.shape[0], 4))
+    jacobian[:, 0] = exponential
+    jacobian[:, 1] = A*exponential*(x-x_0)/width**2
+    jacobian[:, 2] = A*exponential*(x-x_0)**2/width**3
+    jacobian[:, 3] = 1.0
+    return jacobian
+
+
+def gauss(x, A, x_0, width, yoffset):
+    '''
+    Gaussian with a constant offset. Thin wrapper so curve_fit can
+    inspect the signature of the compiled kernel.
+    '''
+    return _gauss_kernel(x, A, x_0, width, yoffset)
+
+
+def gauss_jac(x, A, x_0, width, yoffset):
+    '''
+    Jacobian of gauss with respect to its fit parameters.
+    '''
+    return _gauss_jac_kernel(x, A, x_0, width, yoffset)
+
+
+def gauss_guess(row_data, row_vect):
+    '''
+    Moment-based initial guess for gauss, weighted by intensity above
+    the baseline. Works along the last axis, so a 2-D array of rows
+    gets every guess in one vectorized pass.
+
+    Inputs
+    ------
+    - row_data : array-like
+        Y values, 1-D or one row per fit.
+    - row_vect : array-like
+        X values broadcastable against row_data.
+
+    Returns
+    -------
+    - guess : array-like
+        Array of shape (..., 4) ordered as (A, x_0, width, yoffset).
+    '''
+    baseline = row_data.min(axis=-1, keepdims=True)
+    weights = row_data - baseline
+    total_weight = weights.sum(axis=-1, keepdims=True)
+    # weighted sums as row-wise contractions, so the weighted products are
+    # never materialized; only the centred offset needs a temporary
+    mean = np.einsum('...i,...i->...', weights, row_vect)[..., None] / total_weight
+    offset = row_vect - mean
+    width = np.sqrt(np.einsum('...i,...i,...i->...', weights, offset, offset)[..., None] / total_weight)
+
+    return np.concatenate([row_data.max(axis=-1, keepdims=True) - baseline, mean, width, baseline], axis=-1)
+
 
 ''' ----------------------------------------------------------------
                     SPECTROSCOPY CLASS
@@ -40,6 +149,22 @@ class Spec():
         self.m_i = m_i
 
 
+    @property
+    def m_i(self):
+        '''
+        Ion mass (kg).
+        '''
+        return self._m_i
+
+
+    @m_i.setter
+    def m_i(self, m_i):
+        self._m_i = m_i
+        # m_i c^2 / (8 ln(2) q_i) - converts (FWHM/wavelength)^2 to
+        # temperature, refreshed whenever the ion mass changes
+        self._doppler_k = m_i * self.c * self.c / (8.0 * 0.6931471805599453 * self.q_i)
+
+
     def readSPE(self, file_path, file_name):
         '''
         Pulls data from .SPE file. Stores data in class structure. For 
@@ -61,7 +186,6 @@ class Spec():
         '''
 
         import spe_loader as spe
-        import os
 
         self.full_file_path = os.path.join(file_path, file_name) + ".SPE"
         self.shot_num = file_name
@@ -69,38 +193,48 @@ class Spec():
         try: 
 
             spe_object = spe.SpeFile(self.full_file_path)
-            self.image_data = np.asarray(spe_object.data[0][0])
+            self.image_data = np.asarray(spe_object.data[0][0], dtype=np.float32)
 
             self.wavelength_vector = spe_object.wavelength
-            self.gain = int(spe_object.footer.SpeFormat.DataHistories.DataHistory.Origin.Experiment.Devices.Cameras.Camera.Intensifier.Gain.cdata)
-            self.gate_width = 1e-3*float(spe_object.footer.SpeFormat.DataHistories.DataHistory.Origin.Experiment.Devices.Cameras.Camera.Gating.RepetitiveGate.Pulse['width'])
-            self.gate_delay = 1e-3*float(spe_object.footer.SpeFormat.DataHistories.DataHistory.Origin.Experiment.Devices.Cameras.Camera.Gating.RepetitiveGate.Pulse['delay'])
-            self.yrange = spe_object.ycoord
+
+            # walk the footer tree down to the camera once
+            camera = spe_object.footer.SpeFormat.DataHistories.DataHistory.Origin.Experiment.Devices.Cameras.Camera
+            gate_pulse = camera.Gating.RepetitiveGate.Pulse
+            self.gain = int(camera.Intensifier.Gain.cdata)
+            self.gate_width = 1e-3*float(gate_pulse['width'])
+            self.gate_delay = 1e-3*float(gate_pulse['delay'])
+
+            # ycoord holds one range per ROI, keep ROI 0 to match data[0][0]
+            self.yrange = np.asarray(spe_object.ycoord[0])
             self.ydim = spe_object.ydim[0]
 
-        except AssertionError:
-            '''
-            REQUIRES MATLAB AND THE MATLAB ENGINE INSTALLED!!!11!!!1!
-            see: https://www.mathworks.com/help/matlab/matlab_external/install-the-matlab-engine-for-python.html
-            '''
+        except AssertionError as error:
+            # spe_loader only reads SPE v3.x, anything else is a real error
+            if 'cannot load filetype' not in str(error):
+                raise
 
-            import matlab.engine
+            eng = _getMatlabEngine()
+            matlab_output = eng.loadSPE(os.path.abspath(self.full_file_path), nargout=3)
 
-            os.chdir(os.path.dirname(os.path.abspath(__file__)))
-            
-            eng = matlab.engine.start_matlab()
-            matlab_output = eng.loadSPE(self.full_file_path, nargout=3)
-            eng.quit()
-            
-            self.image_data = np.transpose(np.asarray(matlab_output[0]))
-            self.wavelength_vector = np.asarray(matlab_output[1][0])
+            # matlab.double stores its values column-major in a flat buffer, so
+            # reading it with the shape reversed gives the transpose without
+            # the slow element-by-element conversion
+            self.image_data = np.frombuffer(matlab_output[0]._data, dtype=np.float64).reshape(matlab_output[0].size[::-1]).astype(np.float32)
+            self.wavelength_vector = np.frombuffer(matlab_output[1]._data, dtype=np.float64)
 
             self.ydim = self.image_data.shape[0]
-            self.yrange = range(self.ydim)
+            self.yrange = np.arange(self.ydim)
             
             # import matplotlib.pyplot as plt
             # plt.pcolormesh(self.wavelength_vector, self.yrange, self.image_data, cmap='jet', shading='auto')
 
+        # binData reduces over rows, keep them contiguous in memory regardless
+        # of which reader produced the image (no copy if already C-ordered)
+        self.image_data = np.ascontiguousarray(self.image_data)
+
+        # pixel axis for the wavelength/pixel converters, built once per file
+        self._pix_axis = np.arange(self.ydim, dtype=np.float64)
+
 
     def binData(self, bin_edges):
         '''
@@ -112,19 +246,34 @@ class Spec():
         bin_edges : array-like
             1-D array containing pixel numbers corresponding to 
             bin edges. Method will bin according to pairs of bin
-            edges. 
+            edges. Edges must lie within the image rows and each
+            upper edge must exceed its lower edge.
         '''
 
         self.num_rows = len(bin_edges) // 2
-        self.binned_data = np.zeros([self.num_rows, self.ydim])
-        self.bin_centers = np.zeros(self.num_rows)
-        for chord in range(self.num_rows):
 
-            lower_edge = bin_edges[2*chord]
-            upper_edge = bin_edges[2*chord + 1]
-            
-            self.bin_centers[chord] = (lower_edge + upper_edge) // 2
-            self.binned_data[chord,:] = np.mean(self.image_data[lower_edge:upper_edge, :], axis=0)
+        lower_edges = np.asarray(bin_edges[0:2*self.num_rows:2], dtype=int)
+        upper_edges = np.asarray(bin_edges[1:2*self.num_rows:2], dtype=int)
+
+        # the cumulative-sum lookup below doesn't clamp or wrap like slicing does
+        num_image_rows = self.image_data.shape[0]
+        if np.any(lower_edges < 0) or np.any(upper_edges > num_image_rows):
+            raise ValueError('bin edges must lie within [0, {}]'.format(num_image_rows))
+        if np.any(upper_edges <= lower_edges):
+            raise ValueError('each upper bin edge must be greater than its lower bin edge')
+
+        self.bin_centers = (lower_edges + upper_edges) // 2
+
+        # cumulative sum over rows lets every chord be averaged in one pass,
+        # accumulated in float64 so differencing doesn't lose precision
+        cumulative_data = np.zeros((num_image_rows + 1,) + self.image_data.shape[1:])
+        np.cumsum(self.image_data, axis=0, dtype=np.float64, out=cumulative_data[1:])
+
+        self.binned_data = ((cumulative_data[upper_edges] - cumulative_data[lower_edges])
+            / (upper_edges - lower_edges)[:, None]).astype(np.float32)
+
+        # mean spectrum over all chords, reused by createROI
+        self.mean_binned_data = self.binned_data.mean(axis=0, dtype=np.float64)
 
 
     def sliceROI(self, ROI_edges):
@@ -147,32 +296,64 @@ class Spec():
         return self.binned_data[:, ROI_edges[0]:ROI_edges[1]]
 
 
-    def createROI(self, thresholds, rel_height=0.95):
+    def createROI(self, thresholds, rel_height=0.95, decimation=1):
         '''
         Generates regions of interest given threshold values.
 
         Inputs
         ------
         - thresholds : dict 
-            Dictionary of rel_height and prominence values for 
+            Dictionary containing the prominence value for 
             determining peaks.
+        - (optional) rel_height : float
+            Relative peak height at which the ROI edges are
+            measured.
+        - (optional) decimation : int
+            Factor the mean spectrum is downsampled by for the
+            initial peak search. Peaks are then refined to full
+            resolution. Defaults to 1 (search at full resolution).
+            Lines closer than about one decimation window may be
+            merged into a single ROI.
 
         Returns
         -------
         - ROI_edges : array-like
-            Array of ROI_edges corresponding to the edges of 
+            Array of shape (number of peaks, 2) with the edges of 
             each determined region of interest in pixel space.
         '''
-        from scipy.signal import find_peaks, peak_widths
+        if decimation < 1:
+            raise ValueError('decimation must be a positive integer, got {}'.format(decimation))
+        decimation = int(decimation)
 
         self.thresholds = thresholds
 
-        mean_data = np.mean(self.binned_data, axis=0)
-
-        peaks = find_peaks(mean_data, rel_height=self.thresholds['rel_height'], prominence=self.thresholds['prominence'])
-        edges = peak_widths(mean_data, peaks, rel_height=rel_height)
-
-        ROI_edges = edges[:, 2:3]
+        mean_data = self.mean_binned_data
+
+        if decimation == 1:
+            peak_indices, _ = find_peaks(mean_data, prominence=self.thresholds['prominence'])
+        else:
+            # coarse peak search on a downsampled spectrum
+            num_windows = len(mean_data) // decimation
+            windows = mean_data[:num_windows*decimation].reshape(num_windows, decimation)
+            coarse_peaks, _ = find_peaks(windows.mean(axis=1), prominence=self.thresholds['prominence'])
+
+            # refine each peak over its window and both neighbours, then climb
+            # to the nearest full-resolution local maximum
+            peak_indices = []
+            for coarse_peak in coarse_peaks:
+                lower = max(0, decimation*(coarse_peak - 1))
+                upper = min(len(mean_data), decimation*(coarse_peak + 2))
+                peak = lower + np.argmax(mean_data[lower:upper])
+                while peak > 0 and mean_data[peak - 1] > mean_data[peak]:
+                    peak -= 1
+                while peak < len(mean_data) - 1 and mean_data[peak + 1] > mean_data[peak]:
+                    peak += 1
+                peak_indices.append(peak)
+            peak_indices = np.unique(np.asarray(peak_indices, dtype=int))
+
+        _, _, left_edges, right_edges = peak_widths(mean_data, peak_indices, rel_height=rel_height)
+
+        ROI_edges = np.column_stack([np.floor(left_edges).astype(int), np.ceil(right_edges).astype(int)])
 
         return ROI_edges
 
@@ -185,14 +366,15 @@ class Spec():
         A_max = np.argmax(line_vector)
 
         fit = self.fitGaussian(line_spectra, line_vector)
-        FWHM = fit[2] * (line_vector[1] - line_vector[0])
+        # fit[2] is the Gaussian sigma in line_vector units, FWHM = 2*sqrt(2 ln(2))*sigma
+        FWHM = 2.3548200450309493 * fit[2]
         
-        temp = (FWHM/line_vector[A_max])**2 * self.m_i * self.c**2 / (8 * np.log(2) * self.q_i)
+        temp = (FWHM/line_vector[A_max])**2 * self._doppler_k
 
         return temp, fit
 
 
-    def fitGaussian(self, row_data, row_vect):
+    def fitGaussian(self, row_data, row_vect, guess=None):
         '''
         Fits a Gaussian distribution to an array of 1-D data.
 
@@ -204,6 +386,9 @@ class Spec():
         - row_vect : array-like
             X values, usually of wavelength, corresponding to Y 
             values from row_data.
+        - (optional) guess : array-like
+            Initial fit parameters. Computed with gauss_guess if not
+            given.
 
         Returns
         -------
@@ -214,24 +399,61 @@ class Spec():
             fit_parameters[2] = width -- distribution width
             fit_parameters[3] = yoffest -- height above 0   
         '''
-        from scipy.optimize import curve_fit
+        row_data = np.asarray(row_data, dtype=float)
+        row_vect = np.asarray(row_vect, dtype=float)
 
-        n = len(row_vect)
-        mean = sum(row_data * row_vect)
-        width = sum(row_data* (row_vect-mean)**2)/n
-        guess=[max(row_data), mean, width]
+        if guess is None:
+            guess = gauss_guess(row_data, row_vect)
 
-        def gauss(x, A, x_0, width, yoffset):
-            return A*np.exp(-(x-x_0)**2/(2*width**2)) + yoffset
+        # keep the amplitude positive and the peak/width inside the data window
+        bounds = ([0, row_vect.min(), 0, -np.inf], [np.inf, row_vect.max(), np.ptp(row_vect), np.inf])
 
         try:
-            fit_parameters, covariance = curve_fit(gauss, row_vect, row_data, guess)
+            fit_parameters, covariance = curve_fit(gauss, row_vect, row_data, guess, jac=gauss_jac,
+                method='trf', bounds=bounds, check_finite=False, xtol=1e-5, ftol=1e-5)
         except:
             print('No dice with fit')
             fit_parameters = np.ones(4)
 
         return fit_parameters
-    
+
+
+    def fitGaussianBatch(self, data_rows, row_vect, max_workers=None):
+        '''
+        Fits a Gaussian distribution to each row of a 2-D array, e.g.
+        every chord of the binned data. Fits are independent and are
+        run on a thread pool. The trf solver's iteration loop is Python
+        and holds the GIL, so only the numpy/LAPACK work and the numba
+        kernels overlap between threads; expect modest speedups.
+
+        Inputs
+        ------
+        - data_rows : array-like
+            2-D array of Y values, one row per fit.
+        - row_vect : array-like
+            X values shared by every row, or a 2-D array with one row
+            of X values per row of data_rows.
+        - (optional) max_workers : int
+            Number of threads to use. Defaults to the
+            ThreadPoolExecutor default.
+
+        Returns
+        -------
+        - fit_parameters : array-like
+            Array of shape (number of rows, 4) with the parameters for
+            each fitted Gaussian, ordered as in fitGaussian.
+        '''
+        data_rows = np.asarray(data_rows, dtype=float)
+        row_vects = np.broadcast_to(np.asarray(row_vect, dtype=float), data_rows.shape)
+
+        # every initial guess in one vectorized pass instead of per row
+        guesses = gauss_guess(data_rows, row_vects)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fits = list(executor.map(self.fitGaussian, data_rows, row_vects, guesses))
+
+        return np.asarray(fits)
+
 
     def findPeakWavelength(self, line_spectra, line_vector):
         '''
@@ -259,12 +481,15 @@ class Spec():
         Returns
         -------
         data_pixel_space : numerical or array-like
-            Data converted to pixel space.
+            Data converted to pixel space. Inputs outside the
+            wavelength range are clamped to the first/last pixel
+            rather than raising an error.
         '''
-        from scipy.interpolate import interp1d
-
-        f = interp1d(self.wavelength_vector, self.yrange)
-        data_pixel_space = f(data_wavelength_space)
+        # np.interp needs an increasing axis, flip a descending one
+        if self.wavelength_vector[0] > self.wavelength_vector[-1]:
+            data_pixel_space = np.interp(data_wavelength_space, self.wavelength_vector[::-1], self.yrange[::-1])
+        else:
+            data_pixel_space = np.interp(data_wavelength_space, self.wavelength_vector, self.yrange)
 
         return data_pixel_space  
 
@@ -284,12 +509,11 @@ class Spec():
         Returns
         -------
         data_wavelength_space : numerical or array-like
-            Data converted to wavelength space.
+            Data converted to wavelength space. Inputs outside the
+            pixel range are clamped to the first/last wavelength
+            rather than raising an error.
         '''
-        from scipy.interpolate import interp1d
-
-        f = interp1d(range(self.ydim), self.wavelength_vector)
-        data_wavelength_space = f(data_pixel_space)
+        data_wavelength_space = np.interp(data_pixel_space, self._pix_axis, self.wavelength_vector)
 
         return data_wavelength_space  
 
@@ -300,20 +524,21 @@ class Spec():
         Will be improved once I know how it works.
         '''
         # https://gist.github.com/alexlib/05abf4e42a0341047b1da12e69c2f3a3
-        from scipy.linalg import lstsq
-        from itertools import combinations
-
-        data = [[X], [Y], [Z]]
+        X = np.ravel(X)
+        Y = np.ravel(Y)
+        Z = np.ravel(Z)
 
-        A = np.c_[np.ones(data.shape[0]), data[:,:2], np.prod(data[:,:2], axis=1), data[:,:2]**2]
-        C,_,_,_ = lstsq(A, data[:,2])
+        # design matrix for z = C0 + C1*x + C2*y + C3*x*y + C4*x^2 + C5*y^2
+        A = np.column_stack([np.ones_like(X), X, Y, X*Y, X*X, Y*Y])
+        C,_,_,_ = lstsq(A, Z, lapack_driver='gelsy')
 
         # evaluate it on a grid
         domain_X, domain_Y = np.meshgrid(np.linspace(X.min(), X.max()), np.linspace(Y.min(), Y.max()))
-        domain_XX = domain_X.flatten()
-        domain_YY = domain_Y.flatten()
+        domain_XX = domain_X.ravel()
+        domain_YY = domain_Y.ravel()
 
-        surface = np.dot(np.c_[np.ones(domain_XX.shape), domain_XX, domain_YY, domain_XX*domain_YY, 
-            domain_XX**2, domain_YY**2], C).reshape(domain_X.shape)
+        A_eval = np.column_stack([np.ones_like(domain_XX), domain_XX, domain_YY, domain_XX*domain_YY,
+            domain_XX*domain_XX, domain_YY*domain_YY])
+        surface = (A_eval @ C).reshape(domain_X.shape)
 
         return C, surface
\ No newline at end of file